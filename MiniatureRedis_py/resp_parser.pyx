@@ -0,0 +1,234 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# C implementation of the RESP parser used by ser.py, for requests and replies.
+# Build in place with `cythonize -i resp_parser.pyx`; ser.py falls back to the
+# pure python parser when this module can't be imported.
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.pyport cimport PY_SSIZE_T_MAX
+
+
+cdef enum:
+    INCOMPLETE = -1 # buffer ends before the \r\n terminator
+    MALFORMED = -2 # not a decimal number followed by \r\n
+    MAX_DIGITS = 18 # longer numbers might not fit a long long, the caller reads them with int()
+
+
+cdef object _NO_KEY = object() # a dict being parsed that waits for its next key
+cdef object _PARTIAL = object() # returned for a message cut off at the end of the buffer
+
+
+cdef inline Py_ssize_t _find_crlf(const unsigned char* buf, Py_ssize_t n, Py_ssize_t pos):
+    # offset of the first \r\n at or after pos, like bytes.find in the python parser
+    while pos + 1 < n:
+        if buf[pos] == c'\r' and buf[pos + 1] == c'\n':
+            return pos
+        pos += 1
+    return INCOMPLETE
+
+
+cdef inline Py_ssize_t _find_lf(const unsigned char* buf, Py_ssize_t n, Py_ssize_t pos):
+    # offset of the first \n at or after pos, inline commands end there
+    while pos < n:
+        if buf[pos] == c'\n':
+            return pos
+        pos += 1
+    return INCOMPLETE
+
+
+cdef inline Py_ssize_t _read_int(const unsigned char* buf, Py_ssize_t n, Py_ssize_t pos,
+                                 long long* value, bint* overflow):
+    # reads the decimal number starting at pos, returns the offset just past its \r\n.
+    # more than MAX_DIGITS digits set overflow, and value then only holds the sign (-1 or 1)
+    cdef Py_ssize_t end = _find_crlf(buf, n, pos)
+    cdef long long v = 0
+    cdef bint negative = False
+    cdef unsigned char c
+    if end == INCOMPLETE:
+        return INCOMPLETE
+    if pos < end and buf[pos] == c'-':
+        negative = True
+        pos += 1
+    if pos == end: # no digits at all
+        return MALFORMED
+    overflow[0] = end - pos > MAX_DIGITS
+    while pos < end:
+        c = buf[pos]
+        if c < c'0' or c > c'9':
+            return MALFORMED
+        if not overflow[0]:
+            v = v * 10 + (c - c'0')
+        pos += 1
+    if overflow[0]:
+        v = 1
+    value[0] = -v if negative else v
+    return end + 2 # skip the \r\n
+
+
+cdef inline bint _starts_value(unsigned char c):
+    return c == c'+' or c == c'-' or c == c':' or c == c'$' or c == c'*' or c == c'%'
+
+
+cdef class Parser:
+    cdef object error_type # wraps '-' replies, the Error namedtuple in ser.py
+    cdef object protocol_error # raised for bytes that aren't valid RESP
+    cdef object stop_message # parse_stream stops after this message, the bytes after it use another protocol
+    cdef list stack # open arrays and dicts of a message cut off at the end of the last buffer
+    cdef Py_ssize_t need # buffer length the value it stopped in needs before parsing it again can finish it
+    cdef unsigned char eol # or the end of the line that value waits for, '\r' for \r\n, '\n' for an inline command
+    cdef Py_ssize_t scan # where the search for that line end continues
+
+    def __init__(self, error_type, protocol_error, stop_message=None):
+        self.error_type = error_type
+        self.protocol_error = protocol_error
+        self.stop_message = stop_message
+        self.stack = []
+        self.need = 0
+        self.eol = 0
+        self.scan = 0
+
+    def parse_stream(self, const unsigned char[::1] buf, Py_ssize_t end):
+        # parses every complete message in buf[:end], returns (messages, bytes consumed). Values of a message cut off
+        # at end are kept with their bytes counted as consumed, the next buf has to continue right after them
+        cdef Py_ssize_t n = min(end, buf.shape[0])
+        cdef Py_ssize_t pos = 0
+        cdef Py_ssize_t consumed, found
+        messages = []
+        if n == 0 or n < self.need: # still waiting for the rest of a bulk string
+            return messages, pos
+        if self.eol:
+            if self.eol == c'\r':
+                found = _find_crlf(&buf[0], n, self.scan)
+            else:
+                found = _find_lf(&buf[0], n, self.scan)
+            if found == INCOMPLETE: # the line hasn't ended, the next search starts from here
+                self.scan = max(n - 1, 0) if self.eol == c'\r' else n # a \r\n can be split between two recvs
+                return messages, pos
+        self.need = 0
+        self.eol = 0
+
+        while pos < n:
+            if self.stack or _starts_value(buf[pos]): # the rest of a cut off message is never inline
+                value = self.parse(&buf[pos], n - pos, &consumed)
+            else:
+                value = self.parse_inline(&buf[pos], n - pos, &consumed)
+            if value is _PARTIAL: # the rest stays in buf until more bytes arrive
+                pos += consumed
+                break
+            messages.append(value)
+            pos += consumed
+            if value == self.stop_message:
+                break
+        return messages, pos
+
+    cdef object parse_inline(self, const unsigned char* buf, Py_ssize_t n, Py_ssize_t* consumed):
+        # a plain text command like `SET foo bar\r\n`, as typed into telnet. netcat ends lines with
+        # a bare \n, so the line runs up to \n and a \r before it is stripped by split()
+        cdef Py_ssize_t end = _find_lf(buf, n, 0)
+        consumed[0] = 0
+        if end == INCOMPLETE:
+            return self._suspend([], 0, n, 0, c'\n')
+        consumed[0] = end + 1
+        return PyBytes_FromStringAndSize(<const char*>buf, end).split()
+
+    cdef object _suspend(self, list stack, Py_ssize_t start, Py_ssize_t n, Py_ssize_t need, unsigned char eol):
+        # keeps a message cut off at start, the value there is parsed again once it can be finished. need and the
+        # line end scan are kept relative to start, the next buffer begins there
+        self.stack = stack # everything parsed before that value
+        self.need = need - start if need else 0
+        self.eol = eol
+        self.scan = max(n - start - 1, 0) if eol == c'\r' else n - start
+        return _PARTIAL
+
+    cdef object parse(self, const unsigned char* buf, Py_ssize_t n, Py_ssize_t* consumed):
+        # parses one message from buf, nested arrays and dicts without recursion so deep nesting can't overflow the
+        # C stack. A message cut off at the end of buf returns _PARTIAL with consumed set to the value it stopped in,
+        # what came before that stays in self.stack and the next call carries on from there
+        cdef long long length
+        cdef bint overflow
+        cdef Py_ssize_t pos = 0, start, end
+        cdef unsigned char first
+        stack = self.stack # arrays and dicts still being filled: [container, items left, pending dict key]
+        self.stack = [] # a complete or broken message leaves nothing behind
+
+        while True:
+            consumed[0] = pos # where parsing resumes if this value is cut off
+            if pos >= n:
+                return self._suspend(stack, pos, n, pos + 1, 0)
+            first = buf[pos]
+            start = pos + 1
+
+            if first == c'+' or first == c'-':
+                end = _find_crlf(buf, n, start)
+                if end == INCOMPLETE:
+                    return self._suspend(stack, consumed[0], n, 0, c'\r')
+                value = PyBytes_FromStringAndSize(<const char*>buf + start, end - start)
+                if first == c'-':
+                    value = self.error_type(value)
+                pos = end + 2
+
+            elif first == c':':
+                pos = _read_int(buf, n, start, &length, &overflow)
+                if pos == INCOMPLETE:
+                    return self._suspend(stack, consumed[0], n, 0, c'\r')
+                if pos == MALFORMED:
+                    raise self.protocol_error('bad request')
+                if overflow: # python ints have no upper bound
+                    value = int(PyBytes_FromStringAndSize(<const char*>buf + start, pos - 2 - start))
+                else:
+                    value = length
+
+            elif first == c'$':
+                pos = _read_int(buf, n, start, &length, &overflow)
+                if pos == INCOMPLETE:
+                    return self._suspend(stack, consumed[0], n, 0, c'\r')
+                if pos == MALFORMED or length < -1 or (overflow and length < 0):
+                    raise self.protocol_error('bad request')
+                if overflow: # longer than any buffer, the rest of it can't have arrived yet
+                    return self._suspend(stack, consumed[0], n, PY_SSIZE_T_MAX, 0)
+                if length == -1: # Special-case for NULLs.
+                    value = None
+                else:
+                    if pos + length + 2 > n: # data plus the trailing \r\n
+                        return self._suspend(stack, consumed[0], n, pos + length + 2, 0)
+                    value = PyBytes_FromStringAndSize(<const char*>buf + pos, length)
+                    pos += length + 2
+
+            elif first == c'*' or first == c'%':
+                pos = _read_int(buf, n, start, &length, &overflow)
+                if pos == INCOMPLETE:
+                    return self._suspend(stack, consumed[0], n, 0, c'\r')
+                if pos == MALFORMED or length < 0:
+                    raise self.protocol_error('bad request')
+                if overflow:
+                    count = int(PyBytes_FromStringAndSize(<const char*>buf + start, pos - 2 - start))
+                else:
+                    count = length
+                container = [] if first == c'*' else {}
+                if count:
+                    stack.append([container, count, _NO_KEY]) # its items are the next values parsed
+                    continue
+                value = container
+
+            else:
+                raise self.protocol_error('bad request')
+
+            # add the value to the innermost open container, a full container becomes the value for its parent
+            while stack:
+                frame = stack[len(stack) - 1] # wraparound is off, so no stack[-1]
+                container = frame[0]
+                if type(container) is list:
+                    container.append(value)
+                elif frame[2] is _NO_KEY:
+                    frame[2] = value # each kv pair consists of two elements, the value comes next
+                    break
+                else:
+                    container[frame[2]] = value
+                    frame[2] = _NO_KEY
+                frame[1] -= 1
+                if frame[1]:
+                    break
+                stack.pop()
+                value = container
+            else:
+                consumed[0] = pos # the top level value is complete
+                return value
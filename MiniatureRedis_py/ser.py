@@ -1,139 +1,433 @@
+import os
+os.environ.setdefault('GEVENT_RESOLVER', 'block') # resolve hostnames in place instead of in a threadpool
+from gevent import monkey; monkey.patch_all() # patch the standard library before anything imports socket
+
 from gevent import socket #allows non blocking socket operations
 from gevent.pool import Pool # manages fixed number of greenlets
 from gevent.server import StreamServer # a basic tcp server, handles incoming client connections using greenlets
 
-from collections import namedtuple
-from io import BytesIO # an in - memory stream for bytes
+from collections import OrderedDict, deque, namedtuple
 from socket import error as socket_error # exception for socket-related errors
 import logging
+import struct
+
+try:
+    from resp_parser import Parser # C parser, built with `cythonize -i resp_parser.pyx`
+except ImportError:
+    Parser = None # falls back to the python handlers below
 
 
 logger = logging.getLogger(__name__)
 
+SHARDS = 16 # number of dicts the key value store is split into, must be a power of two
+READ_CACHE_SIZE = 1024 # most recently read values kept in front of the shards
+MAX_CLIENTS = int(os.environ.get('MINIREDIS_MAX_CLIENTS', 1024)) # concurrent connections, one greenlet each
+
 
 class CommandError(Exception): pass #exception raised with problem with a command sent by client
 class Disconnect(Exception): pass # exception raised when client disconnects
 
 Error = namedtuple('Error', ('message',)) # a simple named tuple with one field, 'message'. Used to represent message in a structured way
-client_side = 10
-server_side = 20
+
+_INCOMPLETE = -1 # position the parser returns when a buffer ends in the middle of a message
+_NO_KEY = object() # a dict being parsed that waits for its next key
+_ARRAY, _DICT = ord('*'), ord('%')
+_VALUE_BYTES = b'+-:$*%' # first bytes of RESP values, anything else starts an inline command
+
+HELLO_BIN = b'\x00HELLO-BIN' # inline command a Client(binary=True) sends to switch its connection to binary framing
+_HELLO_BIN_REQUEST = [HELLO_BIN] # the same command once it has been parsed
+_INT32 = struct.Struct('<i') # lengths and counts in binary framing, -1 for null
+_INT64 = struct.Struct('<q') # integers in binary framing
+
+_CRLF = b'\r\n'
+_NULL = b'$-1\r\n'
+_BULK_HEADERS = tuple(b'$%d\r\n' % n for n in range(4096)) # `$<length>\r\n` for the common value sizes
+_INT_CACHE = {i: b':%d\r\n' % i for i in range(-16, 257)} # most integer replies are small counts
+
+
+def _is_number(digits): # only an optional '-' and ascii digits, int() alone would also take spaces, '+' and '_'
+    return (digits[1:] if digits[:1] == b'-' else digits).isdigit()
 
 
 class ProtocolHandler(object):
     def __init__(self):
-        self.handlers = {
-            b'+': self.handle_simple_string,
-            b'-': self.handle_error,
-            b':': self.handle_integer,
-            b'$': self.handle_string,
-            b'*': self.handle_array,
-            b'%': self.handle_dict}
-
-    def handle_request(self, socket_file, system_side): # parse a request from the client 
-        first_byte = socket_file.read(1)
-        # print("hello:",first_byte.decode('ascii')) # THIS WORKS
-        if not first_byte:
-            raise Disconnect()
-
-        try:
-            # Delegate to the appropriate handler based on the first byte.
-            return self.handlers[first_byte](socket_file, system_side)
-        except KeyError:
+        self._dispatch = [None] * 256 # indexed by the first byte of a value, None for bytes that don't start one
+        self._dispatch[ord('+')] = self.handle_simple_string
+        self._dispatch[ord('-')] = self.handle_error
+        self._dispatch[ord(':')] = self.handle_integer
+        self._dispatch[ord('$')] = self.handle_string
+        # arrays and dicts are opened and filled by handle_request itself
+        self.encoders = { # keyed by exact type, containers are handled in encode()
+            bytes: self._encode_bytes,
+            str: self._encode_str,
+            int: self._encode_int,
+            Error: self._encode_error,
+            type(None): self._encode_null}
+        self._parser = Parser(Error, CommandError, _HELLO_BIN_REQUEST) if Parser is not None else None
+        # a message cut off at the end of the buffer is kept between parse_stream calls, so every connection needs
+        # its own handler
+        self._stack = [] # its arrays and dicts still being filled: [container, items left, pending dict key]
+        self._need = 0 # buffer length the value it stopped in needs before parsing it again can finish it
+        self._eol = None # or the end of the line that value waits for
+        self._scan = 0 # where the search for that line end continues
+        self._end = 0 # end of the received bytes in the buffer being parsed
+
+    def parse_stream(self, buf, end=None):
+        # parse every complete message in buf[:end], returns (messages, bytes consumed). Values of a message cut off at
+        # end are kept with their bytes counted as consumed, the next buf has to continue right after them
+        if end is None:
+            end = len(buf)
+        if self._parser is not None:
+            return self._parser.parse_stream(buf, end)
+
+        messages, pos = [], 0
+        if end < self._need: # still waiting for the rest of a bulk string
+            return messages, pos
+        if self._eol is not None:
+            if buf.find(self._eol, self._scan, end) == -1: # the line hasn't ended, the next search starts from here
+                self._scan = max(end - len(self._eol) + 1, 0) # a \r\n can be split between two recvs
+                return messages, pos
+        self._need, self._eol = 0, None
+
+        self._end = end # buf is the receive buffer itself, the bytes after end are left over from earlier recvs
+        while pos < end:
+            if self._stack or buf[pos] in _VALUE_BYTES: # the rest of a cut off message is never inline
+                message, next_pos = self.handle_request(buf, pos)
+            else:
+                message, next_pos = self.handle_inline(buf, pos)
+            if next_pos == _INCOMPLETE: # message is where parsing stopped, the rest stays in buf until more bytes arrive
+                pos = message
+                if self._need: # both kept relative to the next buf, which starts at pos
+                    self._need -= pos
+                if self._eol is not None:
+                    self._scan = max(end - pos - len(self._eol) + 1, 0)
+                break
+            messages.append(message)
+            pos = next_pos
+            if message == _HELLO_BIN_REQUEST: # the bytes after it are binary, leave them in buf
+                break
+        return messages, pos
+
+    # the readers and handlers parse the value starting at buf[pos] and return (value, position after it), or
+    # (wait, _INCOMPLETE) when self._end comes before the value does. wait is the buffer length the value needs, or
+    # None when a line hasn't ended. handle_request and handle_inline return (offset parsing resumes from, _INCOMPLETE)
+    # instead. buf may be a bytearray, values are copied out of it as bytes
+    def _readline(self, buf, pos): # the line starting at pos without its \r\n
+        end = buf.find(b'\r\n', pos, self._end)
+        if end == -1:
+            return None, _INCOMPLETE
+        return bytes(buf[pos:end]), end + 2
+
+    def _read_int(self, buf, pos): # the decimal number starting at pos
+        end = buf.find(b'\r\n', pos, self._end)
+        if end == -1:
+            return None, _INCOMPLETE
+        if end == pos + 1 and 48 <= buf[pos] <= 57: # a single digit, the usual count or length, no slice needed
+            return buf[pos] - 48, end + 2
+        digits = buf[pos:end]
+        if not _is_number(digits):
             raise CommandError('bad request')
+        return int(digits), end + 2
 
-    def handle_simple_string(self, socket_file, system_side):
-        if system_side == server_side:
-            return socket_file.readline().rstrip(b'\r\n')
+    def handle_request(self, buf, pos): # parse a request from the client, nested arrays and dicts without recursion
+        stack = self._stack # arrays and dicts still being filled: [container, items left, pending dict key]
+        self._stack = [] # a complete or broken request leaves nothing behind
+        while True:
+            start = pos
+            if pos >= self._end:
+                return self._suspend(stack, start, pos + 1)
+
+            first_byte = buf[pos] # indexing bytes gives an int, no 1-byte slice to hash
+            if first_byte == _ARRAY or first_byte == _DICT:
+                count, pos = self._read_int(buf, pos + 1)
+                if pos == _INCOMPLETE:
+                    return self._suspend(stack, start, count)
+                if count < 0:
+                    raise CommandError('bad request')
+                container = [] if first_byte == _ARRAY else {}
+                if count:
+                    stack.append([container, count, _NO_KEY]) # its items are the next values parsed
+                    continue
+                value = container
+            else:
+                # Delegate to the appropriate handler based on the first byte.
+                handler = self._dispatch[first_byte]
+                if handler is None:
+                    raise CommandError('bad request')
+                value, pos = handler(buf, pos + 1)
+                if pos == _INCOMPLETE:
+                    return self._suspend(stack, start, value)
+
+            # add the value to the innermost open container, a full container becomes the value for its parent
+            while stack:
+                frame = stack[-1]
+                container = frame[0]
+                if type(container) is list:
+                    container.append(value)
+                elif frame[2] is _NO_KEY:
+                    frame[2] = value # each kv pair consists of two elements, the value comes next
+                    break
+                else:
+                    container[frame[2]] = value
+                    frame[2] = _NO_KEY
+                frame[1] -= 1
+                if frame[1]:
+                    break
+                stack.pop()
+                value = container
+            else:
+                return value, pos # the top level value is complete
+
+    def _suspend(self, stack, start, wait): # keeps a request cut off at start for the next parse_stream call
+        self._stack = stack # everything parsed before it, the value at start is parsed again once it can be finished
+        if wait is None:
+            self._eol = b'\r\n'
         else:
-            data = socket_file.readline().rstrip(b'\r\n')
-            return data.decode('ascii')
+            self._need = wait
+        return start, _INCOMPLETE
 
-    def handle_error(self, socket_file, system_side):
-        if system_side == server_side:
-            return Error(socket_file.readline().rstrip(b'\r\n'))
-        else:
-            data = socket_file.readline().rstrip(b'\r\n')
-            return Error(data.decode('ascii'))
+    def handle_inline(self, buf, pos): # a plain text command like `SET foo bar\r\n`, as typed into telnet
+        end = buf.find(b'\n', pos, self._end) # netcat ends lines with a bare \n, a \r before it is stripped by split()
+        if end == -1:
+            self._eol = b'\n'
+            return pos, _INCOMPLETE
+        return bytes(buf[pos:end]).split(), end + 1
+
+    def handle_simple_string(self, buf, pos):
+        return self._readline(buf, pos)
 
-    def handle_integer(self, socket_file, system_side):
-        return int(socket_file.readline().rstrip(b'\r\n'))
+    def handle_error(self, buf, pos):
+        data, pos = self._readline(buf, pos)
+        if pos == _INCOMPLETE:
+            return data, pos
+        return Error(data), pos
 
-    def handle_string(self, socket_file, system_side):
+    def handle_integer(self, buf, pos):
+        return self._read_int(buf, pos)
+
+    def handle_string(self, buf, pos):
         # First read the length ($<length>\r\n).
-        length = int(socket_file.readline().rstrip(b'\r\n'))
+        length, pos = self._read_int(buf, pos)
+        if pos == _INCOMPLETE:
+            return length, pos
         if length == -1:
-            return None  # Special-case for NULLs.
-        length += 2  # Include the trailing \r\n in count.
-        if system_side == server_side:
-            return socket_file.read(length)[:-2] # returns bytes excluding trailing \r\n
-        else:
-            data = socket_file.read(length)[:-2]
-            return data.decode('ascii')
-
-    def handle_array(self, socket_file, system_side):
-        num_elements = int(socket_file.readline().rstrip(b'\r\n'))
-        # socket_file.readline().rstrip(b'\r\n')
-        # num_elements = int(socket_file)
-        return [self.handle_request(socket_file, system_side) for _ in range(num_elements)]
-    
-    def handle_dict(self, socket_file, system_side):
-        # since each kv pair consists of tewo elements, it reads numItems * 2
-        num_items = int(socket_file.readline().rstrip(b'\r\n'))
-        elements = [self.handle_request(socket_file, system_side)
-                    for _ in range(num_items * 2)]
-        return dict(zip(elements[::2], elements[1::2]))
-        # [::2] takes every second element starting from the first element
-        # [1::2] takes every second element starting from the second element
-        # zip() pairs each key with corresponding value
-        # dict() converts the list of pairs into a dictionary
-
-    def write_response(self, socket_file, data): # serialize the response data and send it to the client
-        buf = BytesIO() #creates in memory buffer, allowing to treat bytes data as file-like-object
-        self._write(buf, data) # serializes data into a byte stream
-        # writing data to buf moves pointer of buf at the end 
-        buf.seek(0) # moves the internal pointer of buf back to the beginning
-        socket_file.write(buf.getvalue()) # retrieves content of buf, writes it to socket_file
-        # .write sends bytes over to the client
-        socket_file.flush() # ensures all data in socket_file is sent out 
-
-    def _write(self, buf, data):
-        if isinstance(data, str): # if data is string, encode to bytes
-            data = data.encode('utf-8')
-
-        if isinstance(data, bytes):
-            buf.write(b'$%d\r\n%s\r\n' % (len(data), data))
-        elif isinstance(data, int):
-            buf.write(b':%d\r\n' % data)
-        elif isinstance(data, Error):
-            buf.write(b'-%s\r\n' % error.message.encode('utf-8'))
-        elif isinstance(data, (list, tuple)): # if data is a list or tuple
-            buf.write(b'*%d\r\n' % len(data))
-            for item in data:
-                self._write(buf, item)
-        elif isinstance(data, dict): # if data is dict
-            buf.write(b'%%%d\r\n' % len(data))
-            for key in data:
-                self._write(buf, key)
-                self._write(buf, data[key])
-        # recursively calls for each key and value
-        elif data is None:
-            buf.write(b'$-1\r\n')
+            return None, pos  # Special-case for NULLs.
+        if length < -1: # would point behind pos and never make progress
+            raise CommandError('bad request')
+        end = pos + length
+        if end + 2 > self._end:  # Include the trailing \r\n in count.
+            return end + 2, _INCOMPLETE
+        return bytes(buf[pos:end]), end + 2 # returns bytes excluding trailing \r\n
+
+    def write_response(self, sock, out, data): # serialize the response data into out and send it to the client
+        del out[:] # drops whatever a failed encode or sendall left behind
+        self.encode(data, out) # serializes data into a byte stream
+        sock.sendall(out) # one sendall for the whole response instead of a write + flush on a socket file
+        del out[:] # the caller keeps using the same bytearray object
+
+    def write_responses(self, sock, out, responses): # serialize a batch of pipelined responses and send them together
+        del out[:]
+        for data in responses:
+            self.encode(data, out)
+        sock.sendall(out)
+        del out[:]
+
+    def encode(self, data, out): # serialize data without recursion, appending it to the bytearray out
+        write = out.extend
+        encoders = self.encoders
+        stack = [data] # values still to be written, the next one on top
+        while stack:
+            data = stack.pop()
+            kind = type(data)
+            encoder = encoders.get(kind) # exact type lookup, cheaper than an isinstance chain
+            if encoder is not None:
+                encoder(data, write)
+            elif kind is list or kind is tuple:
+                write(self._header(b'*', len(data)))
+                stack.extend(reversed(data))
+            elif kind is dict:
+                write(self._header(b'%', len(data)))
+                items = []
+                for key, value in data.items():
+                    items.append(key)
+                    items.append(value)
+                stack.extend(reversed(items)) # each key is written before its value
+            elif isinstance(data, Error):
+                self._encode_error(data, write)
+            elif isinstance(data, (bytes, str, int, list, tuple, dict)):
+                # subclasses (e.g. bool) are written like their base type
+                for base in (bytes, str, int, list, tuple, dict):
+                    if isinstance(data, base):
+                        stack.append(base(data))
+                        break
+            else:
+                raise CommandError('unrecognized type: %s' % type(data))
+
+    def _header(self, marker, length): # `*<count>\r\n` or `%<count>\r\n` in front of an array or dict
+        return b'%s%d\r\n' % (marker, length)
+
+    # each encoder passes the serialized data to write, bulk strings in three pieces to avoid concatenating them
+    def _encode_bytes(self, data, write):
+        length = len(data)
+        if length < 4096:
+            write(_BULK_HEADERS[length])
         else:
-            raise CommandError('unrecognized type: %s' % type(data))
+            write(b'$%d\r\n' % length)
+        write(data)
+        write(_CRLF)
+
+    def _encode_str(self, data, write): # strings are encoded to bytes first
+        self._encode_bytes(data.encode('utf-8'), write)
+
+    def _encode_int(self, data, write):
+        cached = _INT_CACHE.get(data)
+        if cached is None:
+            cached = b':%d\r\n' % data
+        write(cached)
+
+    def _encode_error(self, data, write):
+        message = data.message
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        write(b'-%s\r\n' % message)
+
+    def _encode_null(self, data, write):
+        write(_NULL)
+
+
+class BinaryProtocolHandler(ProtocolHandler):
+    # length-prefixed binary framing, negotiated with HELLO_BIN instead of RESP. Values keep the RESP type bytes
+    # but lengths and counts are little-endian int32 and integers int64, so there are no digits or \r\n to scan.
+    # Integers past int64 are sent as length-prefixed decimal digits behind '(', RESP3's big number type byte
+    def __init__(self):
+        super(BinaryProtocolHandler, self).__init__()
+        self._dispatch[ord('(')] = self.handle_big_number
+        self._parser = None # the C parser only reads RESP
+
+    def handle_inline(self, buf, pos): # there are no inline commands, handle_request rejects bytes that start no value
+        return self.handle_request(buf, pos)
+
+    def _read_int(self, buf, pos): # a length or count
+        if pos + 4 > self._end:
+            return pos + 4, _INCOMPLETE
+        return _INT32.unpack_from(buf, pos)[0], pos + 4
+
+    def handle_integer(self, buf, pos):
+        if pos + 8 > self._end:
+            return pos + 8, _INCOMPLETE
+        return _INT64.unpack_from(buf, pos)[0], pos + 8
+
+    def handle_string(self, buf, pos):
+        length, pos = self._read_int(buf, pos)
+        if pos == _INCOMPLETE:
+            return length, pos
+        if length == -1:
+            return None, pos  # Special-case for NULLs.
+        if length < -1: # would point behind pos and never make progress
+            raise CommandError('bad request')
+        end = pos + length
+        if end > self._end:
+            return end, _INCOMPLETE
+        return bytes(buf[pos:end]), end # raw payload, no trailing \r\n
+
+    handle_simple_string = handle_string
+
+    def handle_big_number(self, buf, pos):
+        digits, pos = self.handle_string(buf, pos)
+        if pos == _INCOMPLETE:
+            return digits, pos
+        if digits is None or not _is_number(digits):
+            raise CommandError('bad request')
+        return int(digits), pos
+
+    def handle_error(self, buf, pos):
+        data, pos = self.handle_string(buf, pos)
+        if pos == _INCOMPLETE:
+            return data, pos
+        return Error(data), pos
+
+    def _header(self, marker, length):
+        return marker + _INT32.pack(length)
+
+    def _encode_bytes(self, data, write):
+        write(self._header(b'$', len(data)))
+        write(data)
+
+    def _encode_int(self, data, write):
+        try:
+            write(b':' + _INT64.pack(data))
+        except struct.error: # RESP clients can store any integer
+            digits = b'%d' % data
+            write(self._header(b'(', len(digits)))
+            write(digits)
+
+    def _encode_error(self, data, write):
+        message = data.message
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        write(self._header(b'-', len(message)))
+        write(message)
+
+    def _encode_null(self, data, write):
+        write(self._header(b'$', -1))
+
+
+class RecvBuffer(object): # bytes received on a socket that haven't been parsed yet
+    def __init__(self, conn, size=65536):
+        self._conn = conn
+        self._size = size # the buffer doubles for bigger messages and goes back to this size after them
+        self._buf = bytearray(size) # preallocated, recv_into writes straight into it
+        self._view = memoryview(self._buf)
+        self._tail = 0 # end of the received bytes
+        self._switched = False # the last parse stopped at HELLO_BIN, the bytes after it haven't been parsed
+
+    def recv(self, protocol): # receives a batch of bytes and returns every complete message in it
+        if self._switched: # parse what arrived after HELLO_BIN with the new protocol before waiting for more
+            self._switched = False
+            messages = self._parse(protocol)
+            if messages:
+                return messages
+
+        if self._tail == len(self._buf): # one message is bigger than the buffer, double it
+            self._view.release()
+            self._buf.extend(bytes(len(self._buf)))
+            self._view = memoryview(self._buf)
+
+        nbytes = self._conn.recv_into(self._view[self._tail:])
+        if not nbytes:
+            raise Disconnect()
+        self._tail += nbytes
+        return self._parse(protocol)
+
+    def _parse(self, protocol): # returns every complete message in the buffer and drops their bytes
+        messages, consumed = protocol.parse_stream(self._buf, self._tail) # parsed in place, no copy
+        if consumed: # move the trailing partial message to the front
+            remaining = self._tail - consumed
+            self._view[:remaining] = self._view[consumed:self._tail]
+            self._tail = remaining
+            if remaining < self._size < len(self._buf): # don't keep a big message's memory for the connection's life
+                buf = bytearray(self._size)
+                buf[:remaining] = self._view[:remaining]
+                self._view.release()
+                self._buf = buf
+                self._view = memoryview(buf)
+        self._switched = bool(self._tail and messages and messages[-1] == _HELLO_BIN_REQUEST)
+        return messages
 
 
 class Server(object): # manages client connections
-    def __init__(self, host='127.0.0.1', port=31337, max_clients=64):
+    def __init__(self, host='127.0.0.1', port=31337, max_clients=MAX_CLIENTS):
         self._pool = Pool(max_clients) # fixed number of greenlets up to max_clients
         self._server = StreamServer( # instance(_server) listens on specified host and port
             (host, port),
             self.connection_handler,
             spawn=self._pool)
 
-        self._protocol = ProtocolHandler() # instance(_protocol) to handle protocol
-        self._kv = {} # dictionary to store key valur pairs
+        self._shards = [dict() for _ in range(SHARDS)] # key value pairs, partitioned by key hash
+        self._read_cache = OrderedDict() # key -> bytes value for recent GETs, least recently used first
 
         self._commands = self.get_commands()
+        self._cmd_cache = {} # raw command token as sent -> handler, so steady traffic skips upper()
 
     def get_commands(self):
         return {
@@ -147,25 +441,43 @@ class Server(object): # manages client connections
 
     def connection_handler(self, conn, address):
         logger.info('Connection received: %s:%s' % address)
-        # Convert "conn" (a socket object) into a file-like object.
-        socket_file = conn.makefile('rwb') #converts socket conn into file like object to read / write binary data (rwb)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # send small replies right away, no Nagle delay
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # notice clients that vanished without closing
+        recv_buffer = RecvBuffer(conn)
+        protocol = ProtocolHandler() # RESP until the client sends HELLO_BIN, it keeps this connection's partial request
+        out = bytearray() # serialized responses waiting for sendall, reused for every batch
 
         # Process client requests until client disconnects.
         while True:
             try:
-                data = self._protocol.handle_request(socket_file, server_side) # parses client request
+                requests = recv_buffer.recv(protocol) # parses every complete client request
             except Disconnect:
                 logger.info('Client went away: %s:%s' % address) # breaks loop when client disconnects
                 break
+            except CommandError as exc: # bytes that aren't a valid request, there's no telling where the next one starts
+                logger.info('Bad request from %s:%s, closing the connection' % address)
+                protocol.write_response(conn, out, Error(exc.args[0]))
+                conn.close()
+                break
 
-            try:
-                # print(data.decode('ascii'))
-                resp = self.get_response(data) # processes request, returns response
-            except CommandError as exc:
-                logger.exception('Command error') # creates an error response if there's an issue w/ command
-                resp = Error(exc.args[0])
+            responses = []
+            for data in requests:
+                if data == _HELLO_BIN_REQUEST: # acknowledged in RESP, everything after it is binary
+                    responses.append(b'OK')
+                    protocol.write_responses(conn, out, responses)
+                    responses = []
+                    protocol = BinaryProtocolHandler()
+                    continue
+
+                try:
+                    resp = self.get_response(data) # processes request, returns response
+                except CommandError as exc:
+                    logger.exception('Command error') # creates an error response if there's an issue w/ command
+                    resp = Error(exc.args[0])
 
-            self._protocol.write_response(socket_file, resp)
+                responses.append(resp)
+
+            protocol.write_responses(conn, out, responses) # a single sendall for the whole pipelined batch
 
     def run(self):
         # starts the server which will now liseten for incoming connections and handle them 
@@ -173,69 +485,137 @@ class Server(object): # manages client connections
 
     def get_response(self, data):
         # here we'll actually unpack the data sent by the client, execute the command they specified and pass back the return value
-        if not isinstance(data, list): # if data is not a list
-            try:
-                data = data.split() # turn to list
-            except:
-                raise CommandError('Request must be list or simple string.')
+        if not isinstance(data, list): # inline commands already arrive split into a list
+            raise CommandError('Request must be list or inline command.')
 
         if not data: # if not command was provided
             raise CommandError('Missing command')
 
-        command = data[0].upper() # extract a command, converted to ensure it matches dict keys
-        if command not in self._commands:
-            raise CommandError('Unrecognized command: %s' % command.decode('ascii'))
-        else:
-            logger.debug('Received %s', command.decode('ascii'))
+        command = data[0]
+        try:
+            handler = self._cmd_cache[command]
+        except KeyError:
+            handler = self._lookup_command(command)
+        except TypeError: # a list or dict where the command name should be
+            raise CommandError('Request must be list or inline command.')
+
+        if handler is None:
+            raise CommandError('Unrecognized command: %s' % command.upper().decode('ascii'))
+        logger.debug('Received %r', command) # the raw token, upper() again would undo the cache
+
+        # corresponding method is called, everything after command is passed. The common arities are called
+        # directly so GET, DELETE and SET don't build an argument tuple from a slice
+        argc = len(data)
+        if argc == 2:
+            return handler(data[1])
+        if argc == 3:
+            return handler(data[1], data[2])
+        if argc == 1:
+            return handler()
+        return handler(*data[1:])
+
+    def _lookup_command(self, command): # resolves a raw command token and remembers the result, unknown ones included
+        try:
+            handler = self._commands.get(command.upper()) # converted to ensure it matches dict keys
+        except AttributeError: # an integer or null where the command name should be
+            raise CommandError('Request must be list or inline command.')
+        if len(self._cmd_cache) >= 256: # bounded, evicts the oldest entry so junk commands can't grow it forever
+            del self._cmd_cache[next(iter(self._cmd_cache))]
+        self._cmd_cache[command] = handler
+        return handler
 
-        return self._commands[command](*data[1:]) # corresponding method is called, everything after command is passed 
+    def _shard(self, key): # the dict that holds key
+        return self._shards[hash(key) & (SHARDS - 1)]
 
     def get(self, key): # retrieves the value associated with the given 'key' from the key-value store
-        return self._kv.get(key) # at self._kv
+        cache = self._read_cache
+        try:
+            value = cache[key]
+        except KeyError:
+            value = self._shard(key).get(key)
+            if type(value) is bytes: # misses and mutable values are never cached
+                cache[key] = value
+                if len(cache) > READ_CACHE_SIZE:
+                    cache.popitem(last=False) # evicts the least recently read key
+            return value
+        cache.move_to_end(key)
+        return value
 
     def set(self, key, value): # updates the value at key
-        self._kv[key] = value
+        self._read_cache.pop(key, None) # every write drops the cached value
+        self._shard(key)[key] = value
         return 1
 
-    def delete(self, key): # if key in self._kv, delete key, return 1
-        if key in self._kv:
-            del self._kv[key]
+    def delete(self, key): # if key in the store, delete key, return 1
+        self._read_cache.pop(key, None)
+        shard = self._shard(key)
+        if key in shard:
+            del shard[key]
             return 1
         return 0 # if not, return 0
 
-    def flush(self):
-        kvlen = len(self._kv) - 1
-        self._kv.clear() # clears the dictionary
+    def flush(self): # removes every key, returns how many there were
+        kvlen = sum(map(len, self._shards)) # counted in one pass, before anything is cleared
+        for shard in self._shards:
+            shard.clear() # empties the dict in place, CPython also frees its table so a flush gives the memory back
+        self._read_cache.clear()
         return kvlen
 
     def mget(self, *keys): # get multiple values associated with multiple keys
-        return [self._kv.get(key) for key in keys]
+        return list(map(self.get, keys)) # each key goes through the read cache like a GET
 
     def mset(self, *items): # sets multiple values
-        data = list(zip(items[::2], items[1::2]))
-        for key, value in data:
-            # print(key, value)
-            self._kv[key] = value
-        # print(len(data))
-        return len(data)
+        shards, mask = self._shards, SHARDS - 1 # bound once instead of looked up for every key
+        drop = self._read_cache.pop
+        it = iter(items)
+        for key, value in zip(it, it): # zip pulls a key then its value from the same iterator, no slice copies
+            drop(key, None)
+            shards[hash(key) & mask][key] = value
+        return len(items) // 2
 
 
 class Client(object):
-    def __init__(self, host='127.0.0.1', port=31337):
+    def __init__(self, host='127.0.0.1', port=31337, decode_responses=False, binary=False):
         self._protocol = ProtocolHandler() # inits an instance of protocalHandler
+        self._decode_responses = decode_responses # responses are bytes unless the caller asks for str
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Creates a new socket using the IPv4 address family (AF_INET) and the TCP protocol (SOCK_STREAM).
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # commands are small, send them right away
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         self._socket.connect((host, port))
-        self._fh = self._socket.makefile('rwb') # converts socket into a file-like object for reading and writing
+        self._recv_buffer = RecvBuffer(self._socket)
+        self._responses = deque() # parsed responses that haven't been returned yet
+        self._out = bytearray() # serialized commands, reused for every request
+        if binary: # ask the server for binary framing, it answers in RESP before switching
+            self._socket.sendall(HELLO_BIN + _CRLF)
+            self._read_response()
+            self._protocol = BinaryProtocolHandler()
 
     def execute(self, *args): # sends command to server, processes response
-        self._protocol.write_response(self._fh, args) # serializes args, writes them to server via 'self._fh'
-        resp = self._protocol.handle_request(self._fh, client_side) # reads the response from the server and deserializes it 
+        self._protocol.write_response(self._socket, self._out, args) # serializes args, sends them to server via 'self._socket'
+        resp = self._read_response() # reads the response from the server and deserializes it
         # print(resp)
+        if self._decode_responses:
+            return self._decode(resp)
+        return resp
+
+    def _read_response(self):
+        while not self._responses:
+            self._responses.extend(self._recv_buffer.recv(self._protocol))
+        resp = self._responses.popleft()
         if isinstance(resp, Error):
-            raise CommandError(resp.message)
+            raise CommandError(resp.message.decode('utf-8', 'replace'))
         return resp
 
+    def _decode(self, value): # bytes become str, lists and dicts are decoded item by item
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        if isinstance(value, list):
+            return [self._decode(item) for item in value]
+        if isinstance(value, dict):
+            return {self._decode(key): self._decode(item) for key, item in value.items()}
+        return value
+
     def get(self, key):
         return self.execute('GET', key)
 
@@ -256,12 +636,10 @@ class Client(object):
 
 
 if __name__ == '__main__': # line ensures the following code runs if the script is executed directly 
-    from gevent import monkey; monkey.patch_all()
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.DEBUG)
     Server().run() # this instantiates the 'server' class ancd calls it's 'run()' method, which starts the server. 
 
-# Patches the standard library for asynchronous operation with gevent.
 # Sets up logging to output detailed debug information to the console.
 # Starts the custom server, which will handle incoming connections in a non-blocking manner, making it capable of serving multiple clients concurrently.
 
@@ -0,0 +1,287 @@
+# Tests for the RESP and binary parsers in ser.py, for messages arriving in pieces, and that the Cython parser in
+# resp_parser.pyx agrees with the python one. Run with `python -m unittest test_resp_parser`, the parity tests
+# need the C parser built and are skipped without it.
+import unittest
+
+import ser
+
+
+CASES = [
+    b'+OK\r\n',
+    b'-ERR boom\r\n',
+    b'+a\rb\r\n', # a lone \r is part of the string
+    b':0\r\n',
+    b':-12\r\n',
+    b':123456789012345678\r\n', # 18 digits, the most a long long is read with
+    b':100000000000000000000\r\n', # past a long long, must not wrap
+    b':-100000000000000000000\r\n',
+    b':\r\n', # no digits
+    b':-\r\n',
+    b': 5\r\n', # int() would accept these
+    b':+5\r\n',
+    b':1_0\r\n',
+    b':1\rX\r\n', # \r not followed by \n
+    b':1\r',
+    b'$3\r\nfoo\r\n',
+    b'$0\r\n\r\n',
+    b'$-1\r\n',
+    b'$-7\r\n',
+    b'$18446744073709551617\r\nx\r\n', # wraps to 1 in 64 bits
+    b'$-18446744073709551617\r\n',
+    b'$5\r\nab',
+    b'*2\r\n:1\r\n$1\r\na\r\n',
+    b'*0\r\n',
+    b'*-1\r\n',
+    b'*1\r\n!x\r\n', # a byte that doesn't start a value
+    b'*2\r\n*1\r\n:1\r\n%1\r\n$1\r\nk\r\n*0\r\n',
+    b'%1\r\n$1\r\nk\r\n:5\r\n',
+    b'%2\r\n$1\r\nk\r\n',
+    b'*100000000000000000000\r\n!x\r\n', # a count past a long long
+    b'GET a\r\n', # inline commands
+    b'GET a\nSET b  c\r\n',
+    b'GET a\r',
+    b'\x00HELLO-BIN\r\n*1\r\n:1\r\n', # parsing stops at HELLO_BIN, the rest is binary
+    b'*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\nb\r\n' * 3 + b'*2\r\n$3\r\nGET\r\n$1',
+]
+
+
+# what the python parser makes of some of the cases
+EXPECTED = [
+    (b'+OK\r\n', ([b'OK'], 5)),
+    (b'-ERR boom\r\n', ([ser.Error(b'ERR boom')], 11)),
+    (b':-12\r\n', ([-12], 6)),
+    (b':100000000000000000000\r\n', ([10 ** 20], 24)),
+    (b'$3\r\nfoo\r\n', ([b'foo'], 9)),
+    (b'$-1\r\n', ([None], 5)),
+    (b'*2\r\n*1\r\n:1\r\n%1\r\n$1\r\nk\r\n*0\r\n', ([[[1], {b'k': []}]], 27)),
+    (b'GET a\nSET b  c\r\n', ([[b'GET', b'a'], [b'SET', b'b', b'c']], 16)),
+    (b'*2\r\n:1\r\n$1\r\na', ([], 8)), # cut off in the bulk string, the values before it are kept
+    (b'GET a\r', ([], 0)),
+    (b'\x00HELLO-BIN\r\n*1\r\n:1\r\n', ([[ser.HELLO_BIN]], 12)),
+    (b'*-1\r\n', ('CommandError', ('bad request',))),
+    (b'$-7\r\n', ('CommandError', ('bad request',))),
+    (b': 5\r\n', ('CommandError', ('bad request',))),
+    (b':\r\n', ('CommandError', ('bad request',))),
+    (b'*1\r\n!x\r\n', ('CommandError', ('bad request',))),
+]
+
+# a pipeline of valid messages, one of each kind
+PIPELINE = (
+    b'*3\r\n$3\r\nSET\r\n$1\r\na\r\n$6\r\nab\r\ncd\r\n'
+    b'%1\r\n$1\r\nk\r\n*2\r\n:-12\r\n+OK\r\n'
+    b'GET a\n'
+    b'$-1\r\n'
+    b':100000000000000000000\r\n'
+    b'-ERR boom\r\n'
+    b'*0\r\n')
+
+PARSERS = [False] + ([True] if ser.Parser is not None else []) # the python parser, and the C one if it is built
+
+
+class FakeConn(object): # stands in for a socket, recv_into hands out data at most chunk bytes at a time
+    def __init__(self, data, chunk):
+        self._data = data
+        self._chunk = chunk
+        self._pos = 0
+        self.sent = bytearray() # everything passed to sendall
+        self.closed = False
+
+    def recv_into(self, view):
+        piece = self._data[self._pos:self._pos + min(self._chunk, len(view))]
+        view[:len(piece)] = piece
+        self._pos += len(piece)
+        return len(piece) # 0 once data runs out, like a closed connection
+
+    def sendall(self, data):
+        self.sent += data
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def make_protocol(c_parser):
+    protocol = ser.ProtocolHandler() # a new one each time, handlers keep a cut off message between calls
+    if not c_parser:
+        protocol._parser = None # forces the python fallback
+    return protocol
+
+
+def parse(c_parser, data):
+    try:
+        return make_protocol(c_parser).parse_stream(data)
+    except ser.CommandError as exc:
+        return 'CommandError', exc.args
+
+
+def parse_in_two(c_parser, data, split): # data arrives in two pieces, the unconsumed bytes are passed again
+    protocol = make_protocol(c_parser)
+    try:
+        messages, consumed = protocol.parse_stream(data[:split])
+        more, more_consumed = protocol.parse_stream(data[consumed:])
+    except ser.CommandError as exc:
+        return 'CommandError', exc.args
+    return messages + more, consumed + more_consumed
+
+
+@unittest.skipIf(ser.Parser is None, 'resp_parser is not built, run `cythonize -i resp_parser.pyx`')
+class ParserParityTest(unittest.TestCase):
+    def assertSameParse(self, data):
+        self.assertEqual(parse(True, data), parse(False, data), data)
+
+    def test_cases(self):
+        for data in CASES:
+            self.assertSameParse(data)
+
+    def test_every_prefix(self):
+        # a message cut anywhere is incomplete on both sides, never misparsed
+        for data in CASES:
+            for end in range(len(data)):
+                self.assertSameParse(data[:end])
+
+    def test_resume(self):
+        for data in CASES:
+            for split in range(len(data)):
+                self.assertEqual(parse_in_two(True, data, split), parse_in_two(False, data, split), (data, split))
+
+    def test_deep_nesting(self):
+        self.assertSameParse(b'*1\r\n' * 100000)
+
+
+class ParserTest(unittest.TestCase): # the python parser, and the C one where it is built
+    def test_cases(self):
+        for data, expected in EXPECTED:
+            for c_parser in PARSERS:
+                self.assertEqual(parse(c_parser, data), expected, (c_parser, data))
+
+    def test_resume(self):
+        # a message cut anywhere carries on from where it stopped once the rest arrives
+        for data in CASES:
+            for c_parser in PARSERS:
+                whole = parse(c_parser, data)
+                for split in range(len(data)):
+                    result = parse_in_two(c_parser, data, split)
+                    if ser.HELLO_BIN in data and split >= len(ser.HELLO_BIN) + 2:
+                        continue # parsing stops at HELLO_BIN, a second call goes on past it
+                    self.assertEqual(result, whole, (c_parser, data, split))
+
+    def test_deep_nesting(self):
+        # nesting is parsed with an explicit stack, it used to overflow the C stack
+        data = b'*1\r\n' * 100000
+        for c_parser in PARSERS:
+            messages, consumed = make_protocol(c_parser).parse_stream(data + b':1\r\n')
+            self.assertEqual(consumed, len(data) + 4)
+            value, depth = messages[0], 0
+            while isinstance(value, list): # walked by hand, == would recurse 100000 levels
+                value, depth = value[0], depth + 1
+            self.assertEqual((value, depth), (1, 100000))
+
+
+def encode_binary(value):
+    out = bytearray()
+    ser.BinaryProtocolHandler().encode(value, out)
+    return bytes(out)
+
+
+class BinaryProtocolTest(unittest.TestCase):
+    VALUE = [b'SET', b'', b'a\r\nb', 'text', 0, -1, 2 ** 63 - 1, -2 ** 63, 10 ** 20, -10 ** 20, None,
+             ser.Error(b'boom'), [], {}, [b'x', [1, {b'k': [b'v', None]}]]]
+    PARSED = [b'SET', b'', b'a\r\nb', b'text', 0, -1, 2 ** 63 - 1, -2 ** 63, 10 ** 20, -10 ** 20, None,
+              ser.Error(b'boom'), [], {}, [b'x', [1, {b'k': [b'v', None]}]]]
+
+    def test_round_trip(self):
+        data = encode_binary(self.VALUE)
+        self.assertEqual(ser.BinaryProtocolHandler().parse_stream(data), ([self.PARSED], len(data)))
+
+    def test_partial_frames(self):
+        # frames cut anywhere are finished once the rest arrives
+        data = encode_binary(self.VALUE) + encode_binary([b'GET', b'k'])
+        whole = ([self.PARSED, [b'GET', b'k']], len(data))
+        for split in range(len(data)):
+            protocol = ser.BinaryProtocolHandler()
+            messages, consumed = protocol.parse_stream(data[:split])
+            more, more_consumed = protocol.parse_stream(data[consumed:])
+            self.assertEqual((messages + more, consumed + more_consumed), whole, split)
+
+    def test_bad_frames(self):
+        for data in (b'$' + ser._INT32.pack(-7), # negative lengths other than the -1 null
+                     b'*' + ser._INT32.pack(-1),
+                     b'*' + ser._INT32.pack(1) + b'!', # a byte that doesn't start a value
+                     b'GET a\r\n', # no inline commands
+                     b'(' + ser._INT32.pack(2) + b'1x',
+                     b'(' + ser._INT32.pack(-1)):
+            with self.assertRaises(ser.CommandError, msg=data):
+                ser.BinaryProtocolHandler().parse_stream(data)
+
+
+class ChunkedDeliveryTest(unittest.TestCase):
+    def receive(self, protocol, data, chunk): # every message in data, received chunk bytes at a time
+        recv_buffer = ser.RecvBuffer(FakeConn(data, chunk))
+        messages = []
+        while True:
+            try:
+                messages.extend(recv_buffer.recv(protocol))
+            except ser.Disconnect:
+                return messages, recv_buffer
+
+    def test_chunk_sizes(self):
+        expected, consumed = make_protocol(False).parse_stream(PIPELINE)
+        self.assertEqual(consumed, len(PIPELINE))
+        for c_parser in PARSERS:
+            for chunk in range(1, len(PIPELINE) + 1):
+                messages, _ = self.receive(make_protocol(c_parser), PIPELINE, chunk)
+                self.assertEqual(messages, expected, (c_parser, chunk))
+
+    def test_hello_bin(self):
+        # the bytes after HELLO_BIN are left for the binary parser, however the stream is cut
+        data = (b'GET a\r\n' + ser.HELLO_BIN + b'\r\n' + encode_binary([b'GET', b'a\r\nb']) +
+                encode_binary([b'SET', b'k', 10 ** 20]))
+        expected = [[b'GET', b'a'], [ser.HELLO_BIN], [b'GET', b'a\r\nb'], [b'SET', b'k', 10 ** 20]]
+        for c_parser in PARSERS:
+            for chunk in range(1, len(data) + 1):
+                recv_buffer = ser.RecvBuffer(FakeConn(data, chunk))
+                protocol = make_protocol(c_parser)
+                messages = []
+                while True: # switches protocols like Server.connection_handler
+                    try:
+                        batch = recv_buffer.recv(protocol)
+                    except ser.Disconnect:
+                        break
+                    for message in batch:
+                        messages.append(message)
+                        if message == [ser.HELLO_BIN]:
+                            protocol = ser.BinaryProtocolHandler()
+                self.assertEqual(messages, expected, (c_parser, chunk))
+
+    def test_large_requests(self):
+        # a big request is parsed as it arrives instead of again from its start after every recv
+        args = [b'MSET'] + [b'k%d' % i for i in range(200000)]
+        mset = b'*%d\r\n' % len(args) + b''.join(b'$%d\r\n%s\r\n' % (len(arg), arg) for arg in args)
+        value = b'v' * (1 << 20)
+        bulk = b'*2\r\n$3\r\nSET\r\n$%d\r\n%s\r\n' % (len(value), value)
+        for c_parser in PARSERS:
+            messages, recv_buffer = self.receive(make_protocol(c_parser), mset, 16384)
+            self.assertEqual(messages, [args])
+            self.assertEqual(len(recv_buffer._buf), 65536) # only the value being received is buffered
+            messages, recv_buffer = self.receive(make_protocol(c_parser), bulk, 16384)
+            self.assertEqual(messages, [[b'SET', value]])
+            self.assertEqual(len(recv_buffer._buf), 65536) # grown for the bulk string and shrunk after it
+
+    def test_waiting_value_is_not_parsed_again(self):
+        # while a bulk string or a line is still arriving its start isn't parsed again for every recv
+        calls = []
+        for data in (b'$%d\r\n%s\r\n' % (1 << 20, b'v' * (1 << 20)), b'GET ' + b'k' * (1 << 20) + b'\n'):
+            protocol = make_protocol(False)
+            handle_string, handle_inline = protocol.handle_string, protocol.handle_inline
+            protocol._dispatch[ord('$')] = lambda buf, pos: calls.append(pos) or handle_string(buf, pos)
+            protocol.handle_inline = lambda buf, pos: calls.append(pos) or handle_inline(buf, pos)
+            del calls[:]
+            messages, _ = self.receive(protocol, data, 4096)
+            self.assertEqual(len(messages), 1)
+            self.assertEqual(len(calls), 2) # when the first chunk arrives and once the last one has
+
+
+if __name__ == '__main__':
+    unittest.main()
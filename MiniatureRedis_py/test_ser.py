@@ -0,0 +1,139 @@
+# Tests for the Server in ser.py, driven through connection_handler with a fake socket instead of the network.
+# Run with `python -m unittest test_ser`.
+import unittest
+
+import ser
+from test_resp_parser import FakeConn
+
+
+class ConnectionHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ser.Server() # the listening socket is only opened by run()
+        ser.logger.disabled = True # command errors are logged with their traceback
+        self.addCleanup(setattr, ser.logger, 'disabled', False)
+
+    def serve(self, data, chunk=65536): # runs a connection that sends data and then closes, returns the conn
+        conn = FakeConn(data, chunk)
+        self.server.connection_handler(conn, ('127.0.0.1', 0))
+        return conn
+
+    def test_requests(self):
+        conn = self.serve(b'*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\nb\r\nGET a\r\n*0\r\n')
+        self.assertEqual(bytes(conn.sent), b':1\r\n$1\r\nb\r\n-Missing command\r\n')
+        self.assertFalse(conn.closed)
+
+    def test_bad_request(self):
+        # a request that can't be parsed gets an error reply and the connection is closed, the rest is never read.
+        # GET a is received on its own, requests in the same recv as a bad one aren't answered
+        for data in (b'*-1\r\n', b'*1\r\n!x\r\n', b':1x\r\n', b'$-7\r\n'):
+            conn = self.serve(b'GET a\r\n' + data + b'GET a\r\n', chunk=7)
+            self.assertEqual(bytes(conn.sent), b'$-1\r\n-bad request\r\n', data)
+            self.assertTrue(conn.closed)
+
+    def test_hello_bin(self):
+        # after HELLO_BIN the connection speaks binary framing, even for bytes that arrived in the same recv.
+        # An integer a RESP client stored past int64 still reaches a binary client
+        binary = ser.BinaryProtocolHandler()
+        requests = bytearray()
+        binary.encode([b'GET', b'n'], requests)
+        binary.encode([b'GET', b'a\r\nb'], requests)
+        data = (b'*3\r\n$3\r\nSET\r\n$1\r\nn\r\n:-100000000000000000000\r\n' + ser.HELLO_BIN + b'\r\n' +
+                bytes(requests))
+        head = b':1\r\n$2\r\nOK\r\n'
+        for chunk in range(1, len(data) + 1):
+            conn = self.serve(data, chunk)
+            self.assertEqual(bytes(conn.sent[:len(head)]), head, chunk)
+            self.assertEqual(ser.BinaryProtocolHandler().parse_stream(bytes(conn.sent[len(head):])),
+                             ([-100000000000000000000, None], len(conn.sent) - len(head)), chunk)
+
+
+class Token(bytes): # a command token that counts its upper() calls
+    uppers = 0
+
+    def upper(self):
+        Token.uppers += 1
+        return bytes.upper(self)
+
+
+class GetResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ser.Server()
+        level = ser.logger.level
+        ser.logger.setLevel(ser.logging.DEBUG) # the level `python3 ser.py` runs with
+        self.addCleanup(ser.logger.setLevel, level)
+
+    def test_command_cache(self):
+        # a command token seen before goes straight to its handler, without upper() even when debug logging is on
+        Token.uppers = 0
+        with self.assertLogs(ser.logger, 'DEBUG'):
+            for _ in range(3):
+                self.assertEqual(self.server.get_response([Token(b'set'), b'k', b'v']), 1)
+                self.assertEqual(self.server.get_response([Token(b'get'), b'k']), b'v')
+        self.assertEqual(Token.uppers, 2)
+        with self.assertRaises(ser.CommandError):
+            self.server.get_response([Token(b'nope')])
+
+
+class ReadCacheTest(unittest.TestCase):
+    # every write has to drop the cached value, a wrong invalidation serves stale data without any error
+    def setUp(self):
+        self.server = ser.Server()
+        self.cache = self.server._read_cache
+
+    def test_get_fills_cache(self):
+        self.server.set(b'k', b'v')
+        self.assertEqual(self.server.get(b'k'), b'v')
+        self.assertEqual(self.cache, {b'k': b'v'})
+        self.assertEqual(self.server.get(b'k'), b'v')
+
+    def test_set_invalidates(self):
+        self.server.set(b'k', b'v1')
+        self.server.get(b'k')
+        self.server.set(b'k', b'v2')
+        self.assertEqual(self.server.get(b'k'), b'v2')
+
+    def test_delete_invalidates(self):
+        self.server.set(b'k', b'v')
+        self.server.get(b'k')
+        self.assertEqual(self.server.delete(b'k'), 1)
+        self.assertIsNone(self.server.get(b'k'))
+        self.assertEqual(self.server.delete(b'k'), 0)
+
+    def test_mset_invalidates(self):
+        self.server.mset(b'a', b'1', b'b', b'2')
+        self.assertEqual(self.server.mget(b'a', b'b', b'c'), [b'1', b'2', None])
+        self.server.mset(b'b', b'3', b'c', b'4')
+        self.assertEqual(self.server.mget(b'a', b'b', b'c'), [b'1', b'3', b'4'])
+
+    def test_flush_invalidates(self):
+        self.server.mset(b'a', b'1', b'b', b'2')
+        self.server.mget(b'a', b'b')
+        self.assertEqual(self.server.flush(), 2)
+        self.assertEqual(self.cache, {})
+        self.assertEqual(self.server.mget(b'a', b'b'), [None, None])
+
+    def test_only_bytes_are_cached(self):
+        # misses aren't cached, and neither are values a caller could mutate or that aren't bytes
+        self.server.set(b'list', [b'x'])
+        self.server.set(b'int', 5)
+        self.assertEqual(self.server.mget(b'list', b'int', b'missing'), [[b'x'], 5, None])
+        self.assertEqual(self.cache, {})
+        self.server.set(b'missing', b'now set')
+        self.assertEqual(self.server.get(b'missing'), b'now set')
+
+    def test_lru_eviction(self):
+        size = ser.READ_CACHE_SIZE
+        for i in range(size + 1):
+            self.server.set(b'k%d' % i, b'v%d' % i)
+        for i in range(size):
+            self.server.get(b'k%d' % i)
+        self.server.get(b'k0') # now the most recently read
+        self.server.get(b'k%d' % size) # evicts k1, the least recently read
+        self.assertEqual(len(self.cache), size)
+        self.assertIn(b'k0', self.cache)
+        self.assertNotIn(b'k1', self.cache)
+        self.assertEqual(self.server.get(b'k1'), b'v1') # still in the shards
+
+
+if __name__ == '__main__':
+    unittest.main()